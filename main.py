@@ -1,11 +1,9 @@
-import collections
-from concurrent.futures import thread
+from concurrent.futures import ThreadPoolExecutor
 import configparser
 import logging
 import os
-import shlex
+import re
 import subprocess
-from datetime import datetime
 import time
 import yaml
 from functools import wraps
@@ -14,72 +12,97 @@ import telegram
 import telegram.ext
 from croniter import croniter
 import threading
-import copy
 from enum import Enum, auto
-from typing import List
+
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
+
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H-%M-%S"
+RSYNC_PROGRESS = re.compile(r"(\d{1,3})%")
 
 
 class Event():
+    _FLAGS = ("_started", "_finished")
 
     def __init__(self) -> None:
-        self.started = threading.Event()
-        self.emit_started = self.started.set
-        self.finished = threading.Event()
-        self.__lock = threading.RLock()
+        self._lock = threading.Lock()
+        self._started = False
+        self._finished = False
+        self.__result = None
+
+    @property
+    def started(self):
+        return self._started
+
+    @property
+    def finished(self):
+        return self._finished
 
     @property
     def result(self):
-        with self.__lock:
-            return copy.deepcopy(self.__result)
+        return self.__result
 
     @result.setter
     def result(self, result):
-        with self.__lock:
-            self.__result = copy.deepcopy(result)
+        self.__result = result
+
+    def emit_started(self):
+        self._started = True
 
     def emit_finished(self, result=None):
-        self.result = result
-        self.finished.set()
+        with self._lock:
+            self.__result = result
+            self._finished = True
 
     def clear(self):
-        self.result = None
-        for name in dir(self):
-            attr = self.__getattribute__(name)
-            if isinstance(attr, threading.Event):
-                attr.clear()
+        with self._lock:
+            self.__result = None
+            for name in self._FLAGS:
+                setattr(self, name, False)
 
 
 class ProgressEvent(Event):
+    _FLAGS = Event._FLAGS + ("_progress", )
 
     def __init__(self) -> None:
         super().__init__()
-        self.progress = threading.Event()
+        self._progress = False
+        self.__progress_value = 0.0
+
+    @property
+    def progress(self):
+        return self._progress
 
     @property
     def progress_value(self):
-        with self.__lock:
-            return copy.deepcopy(self.__progress_value)
+        return self.__progress_value
 
     @progress_value.setter
     def progress_value(self, progress):
-        with self.__lock:
-            self.__progress_value = min(1.0, max(0.0, float(progress)))
+        self.__progress_value = min(1.0, max(0.0, float(progress)))
 
     def emit_progress(self, progress):
-        self.progress_value = progress
-        self.progress.set()
+        with self._lock:
+            self.progress_value = progress
+            self._progress = True
+
+    def clear(self):
+        super().clear()
+        with self._lock:
+            self.__progress_value = 0.0
 
 
 class BaseEvents():
 
     def __init__(self) -> None:
-        pass
+        self._events = ()
 
     def clear_all(self):
-        for name in dir(self):
-            attr = self.__getattribute__(name)
-            if isinstance(attr, Event):
-                attr.clear()
+        for event in self._events:
+            event.clear()
 
 
 class BackupEvents(BaseEvents):
@@ -91,19 +114,32 @@ class BackupEvents(BaseEvents):
         self.database_backup = Event()
         self.data_backup = ProgressEvent()
         self.backup = Event()
+        self._events = (self.enable_maintenance, self.disable_maintenance,
+                        self.database_backup, self.data_backup, self.backup)
 
 
 class BackupThread(threading.Thread):
 
     def __init__(self, nextcloud_dir, backup_dir, database_name) -> None:
         super().__init__(daemon=True)
+        if not os.path.isdir(backup_dir):
+            raise ValueError(
+                f"Backup directory '{backup_dir}' does not exist!")
         self.nextcloud_dir = nextcloud_dir
         self.backup_base_dir = backup_dir
         self.database_name = database_name
         self.backup_subdir = ""
         self.backup_dir = ""
         self.events = BackupEvents()
+        self._rsync_progress = []
+        self._rsync_lock = threading.Lock()
+        self._rsync_processes = []
+        self._rsync_aborted = False
         self._send_message = None
+        occ = ["sudo", "-u", "www-data", "/usr/bin/php",
+               "/var/www/nextcloud/occ"]
+        self._maint_on_argv = occ + ["maintenance:mode", "--on"]
+        self._maint_off_argv = occ + ["maintenance:mode", "--off"]
 
     def set_message_callback(self, fun):
         self._send_message = fun
@@ -117,7 +153,7 @@ class BackupThread(threading.Thread):
     def run(self) -> None:
         self.events.clear_all()
         failed = False
-        self.backup_subdir = datetime.utcnow().strftime("%Y-%m-%d-%H:%M:%S")
+        self.backup_subdir = time.strftime(TIMESTAMP_FORMAT, time.gmtime())
         self.backup_dir = os.path.join(self.backup_base_dir,
                                        self.backup_subdir)
         try:
@@ -126,14 +162,12 @@ class BackupThread(threading.Thread):
             msg = f"Backup directory '{self.backup_dir}' already existing!"
             logging.error(msg)
             self.send_message(msg)
-            failed = True
+            self.events.backup.emit_finished(result=False)
+            return
         except FileNotFoundError:
             msg = f"Backup directory '{self.backup_base_dir}' does not exist!"
             logging.error(msg)
             self.send_message(msg)
-            failed = True
-
-        if failed:
             self.events.backup.emit_finished(result=False)
             return
 
@@ -147,23 +181,27 @@ class BackupThread(threading.Thread):
             self.events.backup.emit_finished(result=False)
             return
 
-        self.events.database_backup.emit_started()
-        success, stdout, stderr = self.mysql_dump()
-        self.events.database_backup.emit_finished(result=success)
-        if not success:
-            failed = True
-            msg = f"Failed to dump database!\n{stderr}"
-            logging.error(msg)
-            self.send_message(msg)
-        else:
+        # Maintenance mode keeps both the database and the data directory
+        # unchanged, so the dump can run alongside the data backup. A failed
+        # dump aborts the data backup, so maintenance mode ends promptly.
+        self._rsync_aborted = False
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            self.events.database_backup.emit_started()
+            dump = executor.submit(self.mysql_dump)
+            dump.add_done_callback(self.dump_finished)
+
             self.events.data_backup.emit_started()
-            success = self.rsync()
+            success, stdout, stderr = self.rsync()
             self.events.data_backup.emit_finished(result=success)
             if not success:
                 failed = True
-                msg = f"Failed to backup data directory!\n{stderr}"
-                logging.error(msg)
-                self.send_message(msg)
+                if not self._rsync_aborted:
+                    msg = f"Failed to backup data directory!\n{stderr}"
+                    logging.error(msg)
+                    self.send_message(msg)
+
+        if not self.events.database_backup.result:
+            failed = True
 
         self.events.disable_maintenance.emit_started()
         success, stdout, stderr = self.disable_maintenance()
@@ -173,56 +211,142 @@ class BackupThread(threading.Thread):
 
         self.events.backup.emit_finished(result=not failed)
 
+    def dump_finished(self, dump):
+        success, stdout, stderr = dump.result()
+        self.events.database_backup.emit_finished(result=success)
+        if not success:
+            msg = f"Failed to dump database!\n{stderr}"
+            logging.error(msg)
+            self.send_message(msg)
+            self.abort_rsync()
+
     def mysql_dump(self):
-        path = os.path.join(self.backup_dir, "nextcloud-sqlbkp.bak")
+        path = os.path.join(self.backup_dir, "nextcloud-sqlbkp")
         logging.info("Creating SQL dump.")
-        cmd = ("mysqldump --defaults-extra-file=user.cnf --single-transaction "
-               "{} > {}".format(self.database_name, path))
+        cmd = [
+            "mydumper", "--defaults-file=user.cnf", "--trx-consistency-only",
+            "--threads={}".format(os.cpu_count() or 1), "--compress",
+            "--rows=50000", "--outputdir={}".format(path),
+            "--database={}".format(self.database_name)
+        ]
         logging.debug("Executing command: %s", cmd)
-        p = subprocess.Popen(shlex.split(cmd),
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE,
-                             universal_newlines=True)
-        stdout, stderr = p.communicate()
-        return (p.returncode == 0), stdout, stderr
+        try:
+            p = subprocess.run(cmd,
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.PIPE,
+                               universal_newlines=True,
+                               check=False)
+        except OSError as e:
+            return False, "", str(e)
+        return (p.returncode == 0), "", p.stderr
 
     def rsync(self):
         path = os.path.join(self.backup_dir, "nextcloud-dirbkp")
         logging.info("Creating Data backup!")
-        cmd = "rsync -Aax --info=progress2 {} {}".format(
-            self.nextcloud_dir, path)
-        p = subprocess.Popen(shlex.split(cmd),
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE,
-                             universal_newlines=True)
-        stdout, stderr = p.communicate()
-        return (p.returncode == 0), stdout, stderr
+        # Lay out the copy like "rsync -Aax <nextcloud_dir> <path>" does: a
+        # trailing slash copies the contents, otherwise the directory itself.
+        src = os.path.join(self.nextcloud_dir, "")
+        root = path
+        if not self.nextcloud_dir.endswith("/"):
+            root = os.path.join(path, os.path.basename(self.nextcloud_dir))
+        try:
+            os.makedirs(path, exist_ok=True)
+            # Copy the root with its owner, mode and ACLs, the top-level files
+            # and the bare top-level directories first. The workers below then
+            # fill in the contents of those directories.
+            success, stdout, stderr = self.rsync_entry(
+                None, src, root, "--exclude=/*/*")
+            if not success:
+                return success, stdout, stderr
+            # Skip mount points, which the -x of a single run would not cross.
+            root_dev = os.stat(src).st_dev
+            with os.scandir(src) as entries:
+                sources = [
+                    entry.path for entry in entries
+                    if entry.is_dir(follow_symlinks=False)
+                    and entry.stat(follow_symlinks=False).st_dev == root_dev
+                ]
+            self._rsync_progress = [0.0] * len(sources)
+            max_workers = min(8, os.cpu_count() or 1)
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                results = list(
+                    executor.map(
+                        lambda item: self.rsync_entry(item[0], item[1], root),
+                        enumerate(sources)))
+        except OSError as e:
+            return False, "", str(e)
+        success = all(result[0] for result in results)
+        stdout = "".join(result[1] for result in results)
+        stderr = "".join(result[2] for result in results)
+        return success, stdout, stderr
+
+    def rsync_entry(self, index, src, dst, *options):
+        cmd = ["rsync", "-Aax", "--info=progress2", *options, "--", src, dst]
+        logging.debug("Executing command: %s", cmd)
+        with self._rsync_lock:
+            if self._rsync_aborted:
+                return False, "", "Data backup aborted."
+            p = subprocess.Popen(cmd,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE,
+                                 bufsize=1,
+                                 universal_newlines=True)
+            self._rsync_processes.append(p)
+        # Drain stderr concurrently so rsync never blocks on a full pipe
+        # while we are reading its progress output.
+        stderr = []
+        stderr_reader = threading.Thread(
+            target=lambda: stderr.append(p.stderr.read()), daemon=True)
+        stderr_reader.start()
+        # progress2 updates are separated by carriage returns, which
+        # universal newlines mode turns into line breaks.
+        for line in iter(p.stdout.readline, ""):
+            match = RSYNC_PROGRESS.search(line)
+            if match and index is not None:
+                self.update_rsync_progress(index,
+                                           int(match.group(1)) / 100.0)
+        p.stdout.close()
+        stderr_reader.join()
+        p.wait()
+        with self._rsync_lock:
+            self._rsync_processes.remove(p)
+        return (p.returncode == 0), "", "".join(stderr)
+
+    def abort_rsync(self):
+        with self._rsync_lock:
+            self._rsync_aborted = True
+            for p in self._rsync_processes:
+                p.terminate()
+
+    def update_rsync_progress(self, index, progress):
+        # Unweighted mean over the top-level entries, i.e. a per-entry
+        # completion ratio. Small entries finish early, so this overstates
+        # progress while large ones such as the data directory still copy.
+        self._rsync_progress[index] = progress
+        self.events.data_backup.emit_progress(
+            sum(self._rsync_progress) / len(self._rsync_progress))
 
     def enable_maintenance(self):
         msg = "Enabling maintenance mode."
         logging.info(msg)
         self.send_message(msg)
-        cmd = ("sudo -u www-data /usr/bin/php /var/www/nextcloud/occ "
-               "maintenance:mode --on")
-        logging.debug("Executing command: %s", cmd)
-        p = subprocess.Popen(shlex.split(cmd),
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE,
-                             universal_newlines=True)
-        stdout, stderr = p.communicate()
-        return (p.returncode == 0), stdout, stderr
+        logging.debug("Executing command: %s", self._maint_on_argv)
+        p = subprocess.run(self._maint_on_argv,
+                           stdout=subprocess.DEVNULL,
+                           stderr=subprocess.PIPE,
+                           universal_newlines=True,
+                           check=False)
+        return (p.returncode == 0), "", p.stderr
 
     def disable_maintenance(self):
         logging.info("Disabling maintenance mode")
-        cmd = ("sudo -u www-data /usr/bin/php /var/www/nextcloud/occ "
-               "maintenance:mode --off")
-        logging.debug("Executing command: %s", cmd)
-        p = subprocess.Popen(shlex.split(cmd),
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE,
-                             universal_newlines=True)
-        stdout, stderr = p.communicate()
-        return (p.returncode == 0), stdout, stderr
+        logging.debug("Executing command: %s", self._maint_off_argv)
+        p = subprocess.run(self._maint_off_argv,
+                           stdout=subprocess.DEVNULL,
+                           stderr=subprocess.PIPE,
+                           universal_newlines=True,
+                           check=False)
+        return (p.returncode == 0), "", p.stderr
 
 
 EXPECT_BACKUP_CONFIRMATION = range(1)
@@ -250,19 +374,24 @@ class Cmd():
         self.is_entrypoint = is_entrypoint
 
 
-def get_cmd(name: str, commands: List[Cmd]):
-    return next((item for item in commands if item.name == name), None)
-
 def permission(permission_level):
     def decorator(f):
         @wraps(f)
         def wrapper(self, update: telegram.Update, context):
-            user_id = update.effective_user.id
-            if self.user_has_permission(user_id, permission_level):
-                logging.info("User %s has sufficient permission level. Has %s and requires %s.", update.effective_user.name, self.user_permission_level(user_id), permission_level)
+            user = update.effective_user
+            user_level = self.user_permission_level(user.id)
+            if (user_level is not None
+                    and user_level.value <= permission_level.value):
+                logging.info(
+                    "User %s has sufficient permission level. "
+                    "Has %s and requires %s.", user.name, user_level,
+                    permission_level)
                 return f(self, update, context)
             else:
-                logging.critical("User %s has not the required permission. User has %s but needs %s.", update.effective_user.name, self.user_permission_level(user_id), permission_level)
+                logging.critical(
+                    "User %s has not the required permission. "
+                    "User has %s but needs %s.", user.name, user_level,
+                    permission_level)
                 return telegram.ext.ConversationHandler.END
 
         return wrapper
@@ -271,6 +400,8 @@ def permission(permission_level):
 class Bot():
 
     def __init__(self) -> None:
+        self._settings_mtime = None
+        self._known_users_mtime = None
         self.read_config()
 
         self.updater = telegram.ext.Updater(self.bot_token)
@@ -294,22 +425,24 @@ class Bot():
                 cb=self.cmd_cancel,
                 permission=CmdPermission.USER)
         ]
+        self._cmd_by_name = {cmd.name: cmd for cmd in self.commands}
+        self._bot_commands = [
+            telegram.bot.BotCommand(cmd.name, cmd.desc)
+            for cmd in self.commands
+        ]
         self.add_commands()
 
     
 
     def add_commands(self):
-        cmds = []
-
         for cmd in self.commands:
             if not cmd.is_entrypoint:
                 self.dispatcher.add_handler(
                     telegram.ext.CommandHandler(command=cmd.name,
                                                 callback=cmd.cb))
-            cmds.append(telegram.bot.BotCommand(cmd.name, cmd.desc))
 
-        cmd = get_cmd("backup", self.commands)
-        fallback_cmd = get_cmd("cancel", self.commands)
+        cmd = self._cmd_by_name["backup"]
+        fallback_cmd = self._cmd_by_name["cancel"]
         conv_handler = telegram.ext.ConversationHandler(
             entry_points=[telegram.ext.CommandHandler(cmd.name, cmd.cb)],
             states={
@@ -329,7 +462,7 @@ class Bot():
             ],
             conversation_timeout=10)
         self.dispatcher.add_handler(conv_handler)
-        self.updater.bot.set_my_commands(cmds)
+        self.updater.bot.set_my_commands(self._bot_commands)
 
     def conversation_timeout(self, update: telegram.Update, context: telegram.ext.CallbackContext):
         try:
@@ -403,6 +536,13 @@ class Bot():
         return False
 
     def read_config(self):
+        self.reload_settings()
+        self.reload_users()
+
+    def reload_settings(self):
+        mtime = os.stat("settings.conf").st_mtime_ns
+        if mtime == self._settings_mtime:
+            return False
         config = configparser.ConfigParser()
         config.read('settings.conf')
         self.bot_token = config["TELEGRAM"]["token"]
@@ -414,8 +554,23 @@ class Bot():
         self.db_name = config["GENERAL"]["database"]
         self.cron_str = config["GENERAL"]["schedule"]
         self.interval = int(config["GENERAL"]["update_interval"])
+        self._settings_mtime = mtime
+        return True
+
+    def reload_users(self):
+        mtime = os.stat("known_telegram_ids.yaml").st_mtime_ns
+        if mtime == self._known_users_mtime:
+            return False
         with open("known_telegram_ids.yaml", "r") as f:
-            self.known_users = yaml.safe_load(f)["known_users"]
+            self.known_users = yaml.load(f, Loader=YamlLoader)["known_users"]
+        self._perm_by_id = {
+            user["id"]: CmdPermission[user["role"].upper()]
+            for user in self.known_users
+        }
+        self._owner_id = next((user["id"] for user in self.known_users
+                               if user["role"] == "owner"), None)
+        self._known_users_mtime = mtime
+        return True
 
     def cmd_start(self, update: telegram.Update,
                   context: telegram.ext.CallbackContext):
@@ -439,34 +594,18 @@ class Bot():
                 logging.error("%s", e)
 
     def is_user_known(self, user_id):
-        if any(d["id"] == user_id for d in self.known_users):
-            return True
-        return False
+        return user_id in self._perm_by_id
 
     def user_permission_level(self, user_id):
         logging.debug("Checking permission level for user %d", user_id)
-        role = next((item["role"] for item in self.known_users if item["id"] == user_id), None)
-        if role is None:
-            return None
-        role = role.upper()
-        return CmdPermission[role]
-    
-    def user_has_permission(self, user_id, required_permission):
-        if not self.is_user_known(user_id):
-            return False
-        user_level = self.user_permission_level(user_id)
-        if required_permission.value < user_level.value:
-            return False
-        return True
+        return self._perm_by_id.get(user_id)
 
     def owner_id(self):
-        return next((item["id"]
-                     for item in self.known_users if item["role"] == "owner"),
-                    None)
+        return self._owner_id
 
 
 def main():
-    name = datetime.now().strftime("%Y-%m-%d-%H:%M:%S")
+    name = time.strftime(TIMESTAMP_FORMAT)
     logging.basicConfig(
         filename="logs/{}.log".format(name),
         level=logging.DEBUG,